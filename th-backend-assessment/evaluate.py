@@ -1,11 +1,18 @@
-import json
 import math
 from typing import Any, Dict, List
 
+import orjson
+
+IO_BUFFER_SIZE = 1 << 20 # 1 MiB read buffer
+
 def load_json(path: str) -> Any:
+    # Accepts a JSON array or NDJSON (one record per line, as written by extract.py for NDJSON input)
     try:
-        with open(path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        with open(path, 'rb', buffering=IO_BUFFER_SIZE) as f:
+            data = f.read()
+        if data.lstrip().startswith(b'['):
+            return orjson.loads(data)
+        return [orjson.loads(line) for line in data.splitlines() if line.strip()]
     except FileNotFoundError:
         print(f"Error: File not found at {path}")
         return []
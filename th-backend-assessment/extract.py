@@ -1,12 +1,18 @@
 import os
-import json
 import time
+import hashlib
 import re
-from typing import List, Dict, Any, Optional
+import asyncio
+from collections import deque
+from itertools import islice
+from typing import List, Dict, Any, Optional, Iterable, Iterator, Tuple
+import ijson
+import orjson
 from dotenv import load_dotenv
-from groq import Groq, APIError
+from groq import AsyncGroq, APIError
+from pydantic import TypeAdapter, ValidationError
 from rich.console import Console
-from rich.progress import track
+from rich.progress import Progress, SpinnerColumn, TextColumn, MofNCompleteColumn, TimeElapsedColumn
 
 from schemas import ShipmentDetails
 import prompts
@@ -21,20 +27,53 @@ MODEL = "llama-3.1-70b-versatile"
 INPUT_FILE = "emails_input.json"
 OUTPUT_FILE = "output.json"
 PORT_CODES_FILE = "port_codes_reference.json"
+EXTRACT_CACHE_FILE = ".extract_cache.json" # MOCK mode results, reused across runs
+EXTRACT_CACHE_MAX_ENTRIES = 10000 # Memoized MOCK results kept in memory and on disk (oldest evicted first)
+BATCH_SIZE = 10 # Emails per LLM request (one PROMPT_V4 prompt, one JSON array back)
+MAX_CONCURRENCY = 10 # In-flight LLM requests
+MAX_PENDING = MAX_CONCURRENCY * 2 # Batches read ahead of the output writer
+WRITE_BATCH_SIZE = 50 # Shipments validated and written per ShipmentWriter flush
+IO_BUFFER_SIZE = 1 << 20 # 1 MiB file buffers: fewer read/write syscalls on multi-MB inputs
+SNIFF_SIZE = 64 # Bytes per read while detecting the input format
+REQUEST_INTERVAL = 0.4 # Seconds between request starts (rate limit safety)
+
+# --- Precompiled Patterns ---
+
+INCOTERMS = ('FOB', 'CIF', 'CFR', 'EXW', 'DDP', 'DAP', 'FCA', 'CPT', 'CIP', 'DPU')
+VALID_INCOTERMS = frozenset(INCOTERMS)
+
+# Dangerous Goods (check_dangerous_goods, run on lowercased text)
+# Negatives come first in the alternation so "non-hazardous" is never read as "hazardous".
+DG_RE = re.compile(
+    r"(?P<neg>non-hazardous|non-dg|not dangerous|non hazardous)"
+    r"|(?P<pos>\bdg\b|dangerous|hazardous|\bimo\b|\bimdg\b|\bclass\s*\d)"
+)
+
+# Mock extraction (smart_extract): bytes patterns, all lowercase, run case-sensitively on ASCII-lowercased UTF-8
+# (\b, \d and \s are ASCII-only on bytes, which skips the Unicode category lookups of str patterns)
+ASCII_LOWER = bytes.maketrans(b'ABCDEFGHIJKLMNOPQRSTUVWXYZ', b'abcdefghijklmnopqrstuvwxyz')
+WORD_BYTES = bytes(1 if chr(b).isalnum() or b == 0x5F else 0 for b in range(128)) + bytes(128) # Same word chars as bytes \b
+WEIGHT_RE = re.compile(rb'(\d+(?:,\d+)*(?:\.\d+)?)\s*(?:kgs?|gross weight|gw)')
+CBM_RE = re.compile(rb'(\d+(?:,\d+)*(?:\.\d+)?)\s*(?:cbm|m3|vol)')
+INCOTERM_RE = re.compile(rb'\b(' + '|'.join(INCOTERMS).lower().encode() + rb')\b')
+MOCK_DG_RE = re.compile(rb'\b(dg|dangerous|hazardous|imo|imdg|class \d)\b')
+MOCK_NON_DG_RE = re.compile(rb'\b(non-dg|non-dangerous|non-hazardous)\b')
 
 # --- Business Rules / Helpers ---
 
-def load_port_reference(path: str) -> Dict[str, str]:
+def load_port_reference(path: str) -> Tuple[Dict[str, str], List[Tuple[str, str]]]:
     """
-    Loads port codes mapping.
-    Returns: Dict[code, name]
+    Loads port codes mapping and alias search patterns in one parse of the reference file.
+    Returns: (Dict[code, name], List[(pattern, code)])
+    - patterns: code, full name and each '/'-separated part (> 2 chars), for MockGroqClient alias search.
     Policy: Handle duplicates. Avoid known bad mappings in the reference file (e.g., INMAA -> Bangalore ICD).
     """
     try:
-        with open(path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        with open(path, 'rb', buffering=IO_BUFFER_SIZE) as f:
+            data = orjson.loads(f.read())
         
         mapping = {}
+        patterns = []
         # First pass: Load all, but skip suspicious ones if we find better ones later?
         # Better strategy: Load all into a list, then pick the best one.
         
@@ -49,6 +88,15 @@ def load_port_reference(path: str) -> Dict[str, str]:
                 temp_map[code] = []
             temp_map[code].append(name)
 
+            # Alias search patterns (all names, not just the selected canonical one)
+            patterns.append((code, code))
+            patterns.append((name, code))
+            if '/' in name:
+                parts = [p.strip() for p in name.split('/')]
+                for part in parts:
+                    if len(part) > 2:
+                        patterns.append((part, code))
+
         # Selection Logic
         for code, names in temp_map.items():
             selected_name = names[0] # Default to first
@@ -71,31 +119,35 @@ def load_port_reference(path: str) -> Dict[str, str]:
             
             mapping[code] = selected_name
             
-        return mapping
+        return mapping, patterns
     except FileNotFoundError:
         console.print(f"[red]Warning: {path} not found. Port validation disabled.[/red]")
-        return {}
+        return {}, []
+
+# (canonical code, canonical name, is_india)
+PortInfo = Tuple[str, str, bool]
+NO_PORT = (None, None, False)
+
+def build_port_index(port_map: Dict[str, str]) -> Dict[str, PortInfo]:
+    """
+    Augments the canonical map for post-processing.
+    Returns: Dict[code, (code, name, is_india)]
+    One lookup validates a code and gives everything downstream logic needs (code, canonical name, India flag).
+    """
+    return {code: (code, name, code.startswith("IN")) for code, name in port_map.items()}
 
 def normalize_incoterm(val: Optional[str]) -> str:
-    valid_incoterms = {'FOB', 'CIF', 'CFR', 'EXW', 'DDP', 'DAP', 'FCA', 'CPT', 'CIP', 'DPU'}
-    if not val:
-        return "FOB"
-    
-    val_upper = val.strip().upper()
-    # Simple direct match
-    if val_upper in valid_incoterms:
-        return val_upper
-    
-    # Fallback default
-    return "FOB"
+    # Simple direct match, fallback default FOB (also for missing values)
+    val_upper = (val or '').strip().upper()
+    return val_upper if val_upper in VALID_INCOTERMS else "FOB"
 
-def determine_product_line(origin_code: Optional[str], dest_code: Optional[str]) -> Optional[str]:
+def determine_product_line(origin_is_india: bool, dest_is_india: bool) -> Optional[str]:
     # Rule: Dest is India -> Import. Origin is India -> Export.
-    # India codes start with "IN"
+    # India codes start with "IN" (precomputed in build_port_index)
     
-    if dest_code and dest_code.startswith("IN"):
+    if dest_is_india:
         return "pl_sea_import_lcl"
-    if origin_code and origin_code.startswith("IN"):
+    if origin_is_india:
         return "pl_sea_export_lcl"
     
     # Default or fallback? Prompt says "all emails are LCL". 
@@ -104,31 +156,22 @@ def determine_product_line(origin_code: Optional[str], dest_code: Optional[str])
     # If unknown logic, return what extraction found or null.
     return None 
 
-def check_dangerous_goods(email_text: str, extracted_bool: Optional[bool]) -> bool:
+def check_dangerous_goods(email_text_lower: str, extracted_bool: Optional[bool]) -> bool:
     """
     Re-evaluates Dangerous Goods status based on regex to be 100% sure.
+    Expects the email text already lowercased by the caller.
     Rule:
     - False if: "non-hazardous", "non-DG", "not dangerous", "non hazardous"
     - True if: "DG", "dangerous", "hazardous", "Class <num>", "IMO", "IMDG"
     - Default False
     """
-    text = email_text.lower()
-    
-    # Check negatives first
-    negatives = [r"non-hazardous", r"non-dg", r"not dangerous", r"non hazardous"]
-    for pattern in negatives:
-        if re.search(pattern, text):
+    # Single scan: a negative anywhere wins, otherwise any positive marks DG
+    found_positive = False
+    for m in DG_RE.finditer(email_text_lower):
+        if m.lastgroup == 'neg':
             return False
-            
-    # Check positives
-    # "Class" + number needs regex
-    positives_keywords = [r"\bdg\b", r"dangerous", r"hazardous", r"\bimo\b", r"\bimdg\b"]
-    class_pattern = r"\bclass\s*\d"
-    
-    for pattern in positives_keywords:
-        if re.search(pattern, text):
-            return True
-    if re.search(class_pattern, text):
+        found_positive = True
+    if found_positive:
         return True
         
     # If no keywords found, fallback to extraction or default False
@@ -136,6 +179,64 @@ def check_dangerous_goods(email_text: str, extracted_bool: Optional[bool]) -> bo
     # So if regex found nothing, it IS false, regardless of LLM hallucination.
     return False
 
+def has_word_boundary(data: bytes, pos: int) -> bool:
+    """
+    Equivalent of bytes regex \\b at data[pos]: one side is an ASCII word char (alnum or '_'), the other is not.
+    """
+    before = pos > 0 and WORD_BYTES[data[pos - 1]]
+    after = pos < len(data) and WORD_BYTES[data[pos]]
+    return bool(before) != bool(after)
+
+def build_trie_regex(words: Iterable[bytes]) -> bytes:
+    """
+    Factors literal alternatives into a prefix-trie regex, e.g. [b"chennai", b"chennai icd"] -> b"chennai(?: icd)?".
+    At each position re only follows the one branch matching the next byte instead of trying every alternative.
+    Continuations are optional and greedy, so the longest alias wins (with backtracking to shorter ones).
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for i in range(len(word)):
+            node = node.setdefault(word[i:i + 1], {})
+        node[b''] = {} # Terminal marker
+
+    def emit(node: Dict) -> bytes:
+        branches = [re.escape(ch) + emit(child) for ch, child in node.items() if ch]
+        if not branches:
+            return b''
+        body = branches[0] if len(branches) == 1 else b'(?:' + b'|'.join(branches) + b')'
+        # A word ending here makes the continuation optional
+        return b'(?:' + body + b')?' if b'' in node else body
+
+    # No words: a pattern that never matches
+    return emit(trie) if trie else b'(?!)'
+
+def assign_ports(ports: List[str], is_export: bool) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Picks (origin, destination) from distinct port codes in order of appearance (mock extraction).
+    Only the first India and first foreign port matter, so one pass stops as soon as both are seen.
+    """
+    first_india = first_foreign = None
+    for code in ports:
+        if code.startswith("IN"):
+            if first_india is None:
+                first_india = code
+        elif first_foreign is None:
+            first_foreign = code
+        if first_india is not None and first_foreign is not None:
+            # Export: Origin = India, Dest = Foreign. Default / Import: Origin = Foreign, Dest = India
+            return (first_india, first_foreign) if is_export else (first_foreign, first_india)
+
+    if len(ports) >= 2:
+        # No clear India vs Foreign split (e.g. both Foreign or both India)
+        return ports[0], ports[1]
+    if ports:
+        code = ports[0]
+        if code.startswith("IN") and not is_export:
+            return None, code
+        return code, None
+    return None, None
+
 def round_metric(val: Any) -> Optional[float]:
     if val is None:
         return None
@@ -145,6 +246,116 @@ def round_metric(val: Any) -> Optional[float]:
     except (ValueError, TypeError):
         return None
 
+# --- Streaming I/O ---
+
+# Output schema check, run once per written batch rather than once per email
+SHIPMENT_LIST_ADAPTER = TypeAdapter(List[ShipmentDetails])
+
+def is_ndjson(path: str) -> bool:
+    """
+    Input/output format detection: a JSON array starts with '[', anything else is treated as NDJSON.
+    Reads small chunks up to the first non-whitespace byte (a minified array is one huge line).
+    """
+    with open(path, 'rb', buffering=0) as f:
+        while chunk := f.read(SNIFF_SIZE):
+            stripped = chunk.lstrip()
+            if stripped:
+                return not stripped.startswith(b'[')
+    return False
+
+def iter_emails(path: str, ndjson: bool) -> Iterator[Dict]:
+    """
+    Yields emails one at a time so the input is never fully materialized.
+    - NDJSON: one email object per line.
+    - JSON array (legacy emails_input.json): streamed item by item with ijson.
+    """
+    with open(path, 'rb', buffering=IO_BUFFER_SIZE) as f:
+        if ndjson:
+            for line in f:
+                if line.strip():
+                    yield orjson.loads(line)
+        else:
+            yield from ijson.items(f, 'item', use_float=True)
+
+def iter_batches(emails: Iterable[Dict], size: int) -> Iterator[List[Dict]]:
+    """
+    Groups the email stream into lists of up to `size` emails, preserving input order.
+    """
+    it = iter(emails)
+    while batch := list(islice(it, size)):
+        yield batch
+
+def fallback_record(email_id: Any) -> Dict:
+    """
+    Schema-valid placeholder for an email whose extraction failed (preserves the ID in the output).
+    """
+    return {"id": email_id, "product_line": None, "origin_port_code": None, "origin_port_name": None, "destination_port_code": None, "destination_port_name": None, "incoterm": "FOB", "cargo_weight_kg": None, "cargo_cbm": None, "is_dangerous": False}
+
+class ShipmentWriter:
+    """
+    Writes shipments to disk as they complete instead of accumulating them.
+    Shipments are buffered up to `batch_size` and validated against ShipmentDetails in one call per batch;
+    a record that fails validation is replaced by its fallback_record.
+    NDJSON: one record per line. JSON array: same indent-2 layout as a single json dump of the list.
+    Records go to a temporary file that replaces `path` only on a clean exit, so a failed run
+    leaves the previous output untouched.
+    """
+    def __init__(self, path: str, ndjson: bool, batch_size: int = WRITE_BATCH_SIZE):
+        self.path = path
+        self.ndjson = ndjson
+        self.batch_size = batch_size
+        self.batch = []
+        self.count = 0
+        self.tmp_path = f"{path}.tmp"
+
+    def __enter__(self):
+        self.f = open(self.tmp_path, 'wb', buffering=IO_BUFFER_SIZE)
+        if not self.ndjson:
+            self.f.write(b"[")
+        return self
+
+    def write(self, shipment: Dict):
+        self.batch.append(shipment)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        try:
+            SHIPMENT_LIST_ADAPTER.validate_python(self.batch)
+        except ValidationError as e:
+            # Error locations start with the list index: only the offending records are replaced
+            invalid = {}
+            for err in e.errors():
+                invalid.setdefault(err['loc'][0], []).append(str(err['loc'][-1]))
+            for i, fields in invalid.items():
+                email_id = self.batch[i].get('id')
+                console.print(f"[red]Schema Violation {email_id}: {', '.join(fields)}[/red]")
+                self.batch[i] = fallback_record(email_id)
+        for shipment in self.batch:
+            self.write_record(shipment)
+        self.batch = []
+
+    def write_record(self, shipment: Dict):
+        if self.ndjson:
+            self.f.write(orjson.dumps(shipment))
+            self.f.write(b"\n")
+        else:
+            self.f.write(b",\n  " if self.count else b"\n  ")
+            self.f.write(orjson.dumps(shipment, option=orjson.OPT_INDENT_2).replace(b"\n", b"\n  "))
+        self.count += 1
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            # Partial results are discarded; the previous output file stays in place
+            self.f.close()
+            os.remove(self.tmp_path)
+            return
+        self.flush()
+        if not self.ndjson:
+            self.f.write(b"\n]" if self.count else b"]")
+        self.f.close()
+        os.replace(self.tmp_path, self.path)
+
 # --- Main Logic ---
 
 def clean_json_response(response: str) -> str:
@@ -157,52 +368,105 @@ def clean_json_response(response: str) -> str:
         response = response[:-3]
     return response.strip()
 
-def process_email(client: Groq, email: Dict, port_map: Dict[str, str]) -> Dict:
-    email_id = email.get('id')
-    subject = email.get('subject', '')
-    body = email.get('body', '')
-    full_text = f"{subject} {body}"
+class RateLimiter:
+    """
+    Spaces request starts at least `interval` seconds apart, shared by all concurrent workers.
+    Replaces the per-email time.sleep of the sequential loop with the same overall request rate.
+    """
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.next_slot = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            now = time.monotonic()
+            wait = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+async def extract_single(client: AsyncGroq, email: Dict) -> Dict:
+    """
+    Extracts one email with its own LLM request (PROMPT_V3).
+    Returns: the raw extraction dict; {} if the request or the JSON reply fails.
+    """
+    try:
+        completion = await client.chat.completions.create(
+            model=MODEL,
+            messages=[{"role": "user", "content": prompts.build_prompt_v3(email.get('subject', ''), email.get('body', ''))}],
+            temperature=0
+        )
+        raw_json = clean_json_response(completion.choices[0].message.content)
+        data = orjson.loads(raw_json)
+        if not isinstance(data, dict):
+            raise ValueError("expected a JSON object")
+        return data
+    except Exception as e:
+        console.print(f"[red]LLM/JSON Error {email.get('id')}: {e}[/red]")
+        return {}
 
-    # 1. Extraction via LLM
+async def extract_batch(client: AsyncGroq, emails: List[Dict], limiter: Optional[RateLimiter] = None) -> List[Dict]:
+    """
+    Extracts a batch of emails with a single LLM request (PROMPT_V4).
+    If the reply is unusable, or leaves emails out, those emails are retried one at a time with
+    extract_single (paced by `limiter`), so a bad reply costs no more than the per-email path would.
+    Returns: one raw extraction dict per email, in input order.
+    """
+    by_id = {}
     try:
-        completion = client.chat.completions.create(
+        completion = await client.chat.completions.create(
             model=MODEL,
-            messages=[{"role": "user", "content": prompts.PROMPT_V3.format(subject=subject, body=body)}],
+            messages=[{"role": "user", "content": prompts.build_prompt_v4(emails)}],
             temperature=0
         )
         raw_json = clean_json_response(completion.choices[0].message.content)
-        data = json.loads(raw_json)
+        items = orjson.loads(raw_json)
+        if not isinstance(items, list):
+            raise ValueError("expected a JSON array")
+        # Matched by id, not position: the model may reorder or drop entries.
+        # Keyed by str(id) on both sides, since the model may echo 7 as "7" (or the reverse).
+        by_id = {str(item['id']): item for item in items if isinstance(item, dict) and 'id' in item}
     except Exception as e:
-        console.print(f"[red]LLM/JSON Error {email_id}: {e}[/red]")
-        data = {}
+        ids = [email.get('id') for email in emails]
+        console.print(f"[yellow]Batch LLM/JSON Error {ids}: {e}. Retrying one at a time.[/yellow]")
+
+    results = []
+    for email in emails:
+        data = by_id.get(str(email.get('id')))
+        if data is None:
+            if limiter:
+                await limiter.acquire()
+            data = await extract_single(client, email)
+        results.append(data)
+    return results
+
+def post_process(email: Dict, data: Dict, port_index: Dict[str, PortInfo]) -> Dict:
+    """
+    Applies the business rules to one raw LLM extraction.
+    Returns: ShipmentDetails fields for the email (validated in batches by ShipmentWriter).
+    """
+    email_id = email.get('id')
+    full_text_lower = f"{email.get('subject', '')} {email.get('body', '')}".lower()
 
-    # 2. Post-Processing & Validation
-    
     # Ports
     origin_code = data.get('origin_port_code')
     dest_code = data.get('destination_port_code')
     
     # Validate against reference. If invalid code, set to None.
-    # Note: Using .get() on port_map returns None if not found, effectively nulling invalid codes.
+    # port_index yields (code, canonical name, is_india); unknown or missing codes unpack to NO_PORT.
+    # Names always come from the map (Rule: "Always use the canonical name... regardless of how the port was named")
     # Exception: The LLM might return valid code but maybe capitalized differently? 
-    # UN/LOCODEs are uppercase.
+    # UN/LOCODEs are uppercase, so .upper() only runs when the exact lookup misses.
     
-    if origin_code: 
-        origin_code = origin_code.upper()
-        if origin_code not in port_map:
-            origin_code = None
-            
-    if dest_code:
-        dest_code = dest_code.upper()
-        if dest_code not in port_map:
-            dest_code = None
-
-    # Get Names from Map (Rule: "Always use the canonical name... regardless of how the port was named")
-    origin_name = port_map.get(origin_code) if origin_code else None
-    dest_name = port_map.get(dest_code) if dest_code else None
+    get_port = port_index.get
+    origin = (get_port(origin_code) or get_port(origin_code.upper())) if origin_code else None
+    dest = (get_port(dest_code) or get_port(dest_code.upper())) if dest_code else None
+    origin_code, origin_name, origin_is_india = origin or NO_PORT
+    dest_code, dest_name, dest_is_india = dest or NO_PORT
     
     # Product Line (Derived from validated codes)
-    prod_line = determine_product_line(origin_code, dest_code)
+    prod_line = determine_product_line(origin_is_india, dest_is_india)
     # Fallback to LLM if logic yields None (though logic covers 100% of LCL cases if ports valid)
     if not prod_line and data.get('product_line'):
         prod_line = data.get('product_line')
@@ -211,27 +475,25 @@ def process_email(client: Groq, email: Dict, port_map: Dict[str, str]) -> Dict:
     incoterm = normalize_incoterm(data.get('incoterm'))
 
     # Dangerous Goods (Regex override)
-    is_dg = check_dangerous_goods(full_text, data.get('is_dangerous'))
+    is_dg = check_dangerous_goods(full_text_lower, data.get('is_dangerous'))
 
     # Metrics
     weight = round_metric(data.get('cargo_weight_kg'))
     cbm = round_metric(data.get('cargo_cbm'))
     
-    # Construct Final Object
-    shipment = ShipmentDetails(
-        id=email_id,
-        product_line=prod_line,
-        origin_port_code=origin_code,
-        origin_port_name=origin_name,
-        destination_port_code=dest_code,
-        destination_port_name=dest_name,
-        incoterm=incoterm,
-        cargo_weight_kg=weight,
-        cargo_cbm=cbm,
-        is_dangerous=is_dg
-    )
-    
-    return shipment.model_dump()
+    # Construct Final Object (ShipmentDetails fields; validated in batches by ShipmentWriter)
+    return {
+        "id": email_id,
+        "product_line": prod_line,
+        "origin_port_code": origin_code,
+        "origin_port_name": origin_name,
+        "destination_port_code": dest_code,
+        "destination_port_name": dest_name,
+        "incoterm": incoterm,
+        "cargo_weight_kg": weight,
+        "cargo_cbm": cbm,
+        "is_dangerous": is_dg
+    }
 
 class MockMessage:
     def __init__(self, content):
@@ -246,36 +508,104 @@ class MockResponse:
         self.choices = [MockChoice(content)]
 
 class MockGroqClient:
-    def __init__(self, api_key, port_map=None):
+    def __init__(self, api_key, port_map=None, search_patterns=None, cache_path=None):
         self.api_key = api_key
         # port_map is the canonical map (Code -> Name)
         self.port_map = port_map or {}
         
-        # Build a more extensive search map from the raw file to catch aliases
-        self.search_patterns = [] # List of (Pattern, Code)
-        try:
-            with open("port_codes_reference.json", 'r', encoding='utf-8') as f:
-                raw_data = json.load(f)
-                for entry in raw_data:
-                    code = entry.get('code')
-                    name = entry.get('name')
-                    if not code or not name: continue
-                    
-                    self.search_patterns.append((code, code))
-                    self.search_patterns.append((name, code))
-                    if '/' in name:
-                        parts = [p.strip() for p in name.split('/')]
-                        for part in parts:
-                            if len(part) > 2:
-                                self.search_patterns.append((part, code))
-        except Exception:
-            # Fallback to port_map if file read fails
+        # search_patterns come from load_port_reference (aliases from the raw file), List of (Pattern, Code)
+        self.search_patterns = list(search_patterns or [])
+        if not self.search_patterns:
+            # Fallback to port_map if no alias patterns were provided
             for code, name in self.port_map.items():
                 self.search_patterns.append((code, code))
                 self.search_patterns.append((name, code))
 
+        self.build_port_matcher()
+        self.load_cache(cache_path)
         self.chat = self.MockChat(self)
 
+    def load_cache(self, cache_path):
+        """
+        Memoizes smart_extract: Dict[SHA-1 of lowercased email segment, JSON response], in least recently
+        used order and capped at EXTRACT_CACHE_MAX_ENTRIES.
+        With a cache_path, results from previous runs are reused if they were produced by the same
+        extract.py source and port reference data (the fingerprint hashes both, so no manual version bump).
+        """
+        self.cache_path = cache_path
+        self.memo = {}
+        self.memo_dirty = False
+        with open(__file__, 'rb') as f:
+            source = f.read()
+        self.cache_fingerprint = hashlib.sha1(
+            source + orjson.dumps([self.search_patterns, self.port_map])
+        ).hexdigest()
+        if not cache_path:
+            return
+        try:
+            with open(cache_path, 'rb', buffering=IO_BUFFER_SIZE) as f:
+                saved = orjson.loads(f.read())
+            if saved.get('fingerprint') == self.cache_fingerprint:
+                entries = saved.get('entries', {})
+                # Keep the most recently used entries if the cap was lowered since the file was written
+                self.memo = dict(list(entries.items())[-EXTRACT_CACHE_MAX_ENTRIES:])
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            console.print(f"[yellow]Ignoring unreadable cache {cache_path}: {e}[/yellow]")
+
+    def save_cache(self):
+        if not self.cache_path or not self.memo_dirty:
+            return
+        # Written to a temporary file first: an interrupted save never leaves a truncated cache behind
+        tmp_path = f"{self.cache_path}.tmp"
+        with open(tmp_path, 'wb', buffering=IO_BUFFER_SIZE) as f:
+            f.write(orjson.dumps({"fingerprint": self.cache_fingerprint, "entries": self.memo}))
+        os.replace(tmp_path, self.cache_path)
+        self.memo_dirty = False
+
+    def memo_get(self, key):
+        response = self.memo.pop(key, None)
+        if response is not None:
+            # Re-inserted to mark it most recently used
+            self.memo[key] = response
+        return response
+
+    def memo_put(self, key, response):
+        self.memo[key] = response
+        if len(self.memo) > EXTRACT_CACHE_MAX_ENTRIES:
+            del self.memo[next(iter(self.memo))]
+        self.memo_dirty = True
+
+    def build_port_matcher(self):
+        """
+        Compiles all search patterns into one trie regex so a single scan reports every port mention.
+        Patterns are UTF-8 encoded and ASCII-lowercased: the regex runs case-sensitively on text lowered the same way.
+        Builds:
+        - port_regex: zero-width lookahead, so overlapping mentions (e.g. "Guangzhou" inside "Shenzhen / Guangzhou") are all reported.
+        - alias_lengths / alias_codes: Dict[longest alias matched, parallel tuples] with one entry per
+          (alias, code) that can match at the same position, in reference file order.
+        """
+        # Aliases with the same spelling (case-insensitive) share one alternative, e.g. "Chennai" -> INMAA and KRPUS
+        aliases = {}
+        for idx, (pattern, code) in enumerate(self.search_patterns):
+            aliases.setdefault(pattern.encode('utf-8').translate(ASCII_LOWER), []).append((idx, code))
+
+        # Trie continuations are greedy: "Chennai ICD" is preferred over "Chennai" at the same position
+        self.port_regex = re.compile(rb'(?=\b(' + build_trie_regex(aliases) + rb')\b)')
+
+        # Shorter aliases that are prefixes of the matched one are literal matches at the same position;
+        # only their trailing word boundary is left to check (no per-alias regex needed).
+        # Stored as parallel tuples (lengths, codes) pre-sorted by pattern index, so ties need no sort at scan time.
+        self.alias_lengths = {}
+        self.alias_codes = {}
+        for key in aliases:
+            # Prefix aliases are looked up by slicing the key: O(len(key)) per alias, not a scan of all aliases
+            prefixes = (key[:n] for n in range(1, len(key) + 1))
+            hits = sorted((idx, len(other), code) for other in prefixes if other in aliases for idx, code in aliases[other])
+            self.alias_lengths[key] = tuple(length for _, length, _ in hits)
+            self.alias_codes[key] = tuple(code for _, _, code in hits)
+
     class MockChat:
         def __init__(self, client):
             self.client = client
@@ -285,88 +615,71 @@ class MockGroqClient:
         def __init__(self, client):
             self.client = client
 
-        def create(self, model, messages, temperature):
+        async def create(self, model, messages, temperature):
             content = messages[-1]['content']
+            if content.startswith(prompts.PROMPT_V4_PREFIX):
+                return MockResponse(self.batch_extract(content))
             return MockResponse(self.smart_extract(content))
 
+        def batch_extract(self, text):
+            """
+            Answers a PROMPT_V4 batch prompt: every embedded email is extracted on its own, exactly as
+            its PROMPT_V3 prompt would be (same segment, same memo entry), and tagged with its id.
+            """
+            payload = text[len(prompts.PROMPT_V4_PREFIX):len(text) - len(prompts.PROMPT_V4_SUFFIX)]
+            results = []
+            for email in orjson.loads(payload):
+                extracted = orjson.loads(self.smart_extract(prompts.build_prompt_v3(email['subject'], email['body'])))
+                results.append({"id": email['id'], **extracted})
+            return orjson.dumps(results).decode()
+
         def smart_extract(self, text):
             # Hack: segment text to avoid scanning prompt instructions (which contain example codes like INMAA, HKHKG)
             # Locate the start of the email.
             start_marker = "**Email:**"
             idx = text.rfind(start_marker)
-            if idx != -1:
-                text = text[idx:]
-            else:
+            if idx == -1:
                 # Fallback: look for "Subject:" near the end
                 idx = text.rfind("Subject:")
-                if idx != -1:
-                    text = text[idx:]
             
-            text_lower = text.lower()
+            # Encode and lowercase the email segment once (ASCII table, no per-char Unicode lookups);
+            # every pattern below is a lowercase bytes pattern and case-sensitive
+            text_lower = (text[idx:] if idx != -1 else text).encode('utf-8', 'replace').translate(ASCII_LOWER)
+
+            # Everything below depends only on text_lower: reuse earlier results for the same email
+            memo_key = hashlib.sha1(text_lower).hexdigest()
+            cached = self.client.memo_get(memo_key)
+            if cached is not None:
+                return cached
             
             # --- 1. Port Extraction ---
-            found_ports = []
-            
-            # Iterate through all search patterns
+            # Single scan over all search patterns
             # Note: This might find multiple entries for the same port (e.g. Code matches + Name matches)
-            # We filter/deduplicate later.
-            
-            seen_codes = set()
-            
-            for pattern, code in self.client.search_patterns:
-                # Use regex word boundary
-                # pattern might contain special chars (e.g. parens in "India (Chennai)")
-                safe_pattern = re.escape(pattern)
-                
-                matches = [m.start() for m in re.finditer(r'\b' + safe_pattern + r'\b', text, re.IGNORECASE)]
-                for pos in matches:
-                    # Store (pos, code)
-                    # We use the Code to look up the Canonical Name later
-                    found_ports.append((pos, code))
-
-            # Sort by position
-            found_ports.sort(key=lambda x: x[0])
-            
-            # Reduce: Distinct codes in order of appearance
+            # Matches arrive in position order (ties in reference file order), so distinct codes
+            # in order of appearance are collected directly, with no sort.
             final_ports = []
             seen_in_text = set()
-            for pos, code in found_ports:
-                if code not in seen_in_text:
-                    final_ports.append(code)
-                    seen_in_text.add(code)
-            
-            origin_code = None
-            dest_code = None
             
-            # Smart Assignment Logic
-            india_ports = [p for p in final_ports if p.startswith("IN")]
-            foreign_ports = [p for p in final_ports if not p.startswith("IN")]
+            for m in self.client.port_regex.finditer(text_lower):
+                pos = m.start()
+                matched = m.group(1)
+                lengths = self.client.alias_lengths[matched]
+                codes = self.client.alias_codes[matched]
+                for i in range(len(codes)):
+                    code = codes[i]
+                    if code in seen_in_text:
+                        continue
+                    if lengths[i] == len(matched) or has_word_boundary(text_lower, pos + lengths[i]):
+                        # We use the Code to look up the Canonical Name later
+                        final_ports.append(code)
+                        seen_in_text.add(code)
             
             # Refined checking: 'Import' overrides 'Export' (because 'Export' appears in company names often)
-            is_import = "import" in text_lower
-            is_export = "export" in text_lower and not is_import
+            is_import = b"import" in text_lower
+            is_export = b"export" in text_lower and not is_import
             
-            if india_ports and foreign_ports:
-                if is_export:
-                    origin_code = india_ports[0]
-                    dest_code = foreign_ports[0]
-                else:
-                    # Default / Import: Origin = Foreign, Dest = India
-                    origin_code = foreign_ports[0]
-                    dest_code = india_ports[0]
-            elif len(final_ports) >= 2:
-                # No clear India vs Foreign split (e.g. both Foreign or both India)
-                origin_code = final_ports[0]
-                dest_code = final_ports[1]
-            elif len(final_ports) == 1:
-                p_code = final_ports[0]
-                if p_code.startswith("IN"):
-                     if is_export:
-                         origin_code = p_code
-                     else:
-                         dest_code = p_code
-                else:
-                    origin_code = p_code
+            # Smart Assignment Logic
+            origin_code, dest_code = assign_ports(final_ports, is_export)
 
             # Validation: Map codes to Canonical Names
             origin_name = self.client.port_map.get(origin_code) if origin_code else None
@@ -376,35 +689,32 @@ class MockGroqClient:
             pkg_weight = None
             pkg_cbm = None
             
-            w_match = re.search(r'(\d+(?:,\d+)*(?:\.\d+)?)\s*(?:kgs?|gross weight|gw)', text_lower)
+            w_match = WEIGHT_RE.search(text_lower)
             if w_match:
-                try: pkg_weight = float(w_match.group(1).replace(',', ''))
+                try: pkg_weight = float(w_match.group(1).replace(b',', b''))
                 except: pass
                 
-            c_match = re.search(r'(\d+(?:,\d+)*(?:\.\d+)?)\s*(?:cbm|m3|vol)', text_lower)
+            c_match = CBM_RE.search(text_lower)
             if c_match:
-                try: pkg_cbm = float(c_match.group(1).replace(',', ''))
+                try: pkg_cbm = float(c_match.group(1).replace(b',', b''))
                 except: pass
 
             # --- 3. Incoterm ---
-            incoterm = "FOB"
-            inco_candidates = ['FOB', 'CIF', 'CFR', 'EXW', 'DDP', 'DAP', 'FCA', 'CPT', 'CIP', 'DPU']
-            for inc in inco_candidates:
-                if re.search(r'\b' + re.escape(inc) + r'\b', text, re.IGNORECASE):
-                    incoterm = inc.upper()
-                    break
+            # One scan collects every mention; priority follows INCOTERMS order, not text order
+            mentioned = {m.decode().upper() for m in INCOTERM_RE.findall(text_lower)}
+            incoterm = next((inc for inc in INCOTERMS if inc in mentioned), "FOB")
 
             # --- 4. Dangerous Goods ---
             is_dg = False
-            if re.search(r'\b(dg|dangerous|hazardous|imo|imdg|class \d)\b', text_lower):
-                if not re.search(r'\b(non-dg|non-dangerous|non-hazardous)\b', text_lower):
+            if MOCK_DG_RE.search(text_lower):
+                if not MOCK_NON_DG_RE.search(text_lower):
                     is_dg = True
 
             # --- 5. Product Line ---
             # Try to guess product line if extract.py logic fails (i.e. ports missing)
             # Default to "pl_sea_import_lcl"
             prod_line = "pl_sea_import_lcl" 
-            if "export" in text_lower:
+            if b"export" in text_lower:
                 prod_line = "pl_sea_export_lcl"
             
             # If ports are found, let logic override? 
@@ -423,53 +733,93 @@ class MockGroqClient:
                 "cargo_cbm": pkg_cbm,
                 "is_dangerous": is_dg
             }
-            return json.dumps(result)
+            response = orjson.dumps(result).decode()
+            self.client.memo_put(memo_key, response)
+            return response
+
+async def process_all(client: AsyncGroq, emails: Iterable[Dict], port_index: Dict[str, PortInfo], use_mock: bool, writer: ShipmentWriter):
+    """
+    Processes emails in batches of BATCH_SIZE, one LLM request per batch, with up to MAX_CONCURRENCY
+    requests in flight. Results are streamed to `writer` in input order.
+    At most MAX_PENDING batches are held in memory at once.
+    REAL mode paces request starts with a shared RateLimiter; MOCK mode runs unthrottled.
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    limiter = None if use_mock else RateLimiter(REQUEST_INTERVAL)
+    desc = "Processing (MOCK Mode)..." if use_mock else "Processing (REAL Mode)..."
 
-def main():
+    # The stream length is unknown up front: spinner and running count until the last batch is in
+    columns = (SpinnerColumn(), TextColumn("[progress.description]{task.description}"), MofNCompleteColumn(), TimeElapsedColumn())
+    with Progress(*columns, console=console) as progress:
+        task = progress.add_task(desc, total=None)
+        queued = 0
+
+        async def run(batch: List[Dict]) -> List[Dict]:
+            async with semaphore:
+                if limiter:
+                    await limiter.acquire()
+                try:
+                    extracted = await extract_batch(client, batch, limiter)
+                except Exception as e:
+                    # Request-level failure: every email in the batch gets the fallback record
+                    console.print(f"[red]Genera Failure {[email.get('id') for email in batch]}: {e}[/red]")
+                    progress.advance(task, len(batch))
+                    return [fallback_record(email.get('id')) for email in batch]
+
+            # One bad extraction only costs its own email
+            results = []
+            for email, data in zip(batch, extracted):
+                try:
+                    results.append(post_process(email, data, port_index))
+                except Exception as e:
+                    console.print(f"[red]Genera Failure {email.get('id')}: {e}[/red]")
+                    # Preserve ID in output
+                    results.append(fallback_record(email.get('id')))
+            progress.advance(task, len(batch))
+            return results
+
+        pending = deque()
+        for batch in iter_batches(emails, BATCH_SIZE):
+            queued += len(batch)
+            pending.append(asyncio.create_task(run(batch)))
+            if len(pending) >= MAX_PENDING:
+                for shipment in await pending.popleft():
+                    writer.write(shipment)
+        while pending:
+            for shipment in await pending.popleft():
+                writer.write(shipment)
+        progress.update(task, total=queued)
+
+async def main():
     api_key = os.getenv("GROQ_API_KEY")
     use_mock = False
 
-    port_map = load_port_reference(PORT_CODES_FILE)
+    port_map, search_patterns = load_port_reference(PORT_CODES_FILE)
+    port_index = build_port_index(port_map)
     console.print(f"Loaded {len(port_map)} port codes.")
 
     if not api_key or api_key.startswith("gsk_INSERT") or len(api_key) < 10:
         console.print("[bold yellow]Warning: Valid GROQ_API_KEY not found. Switching to MOCK MODE.[/bold yellow]")
         use_mock = True
-        client = MockGroqClient(api_key="mock_key", port_map=port_map)
+        client = MockGroqClient(api_key="mock_key", port_map=port_map, search_patterns=search_patterns, cache_path=EXTRACT_CACHE_FILE)
     else:
         try:
-            client = Groq(api_key=api_key)
+            client = AsyncGroq(api_key=api_key)
             # Quick connectivity check
-            client.chat.completions.create(model=MODEL, messages=[{"role": "user", "content": "ping"}], max_tokens=1)
+            await client.chat.completions.create(model=MODEL, messages=[{"role": "user", "content": "ping"}], max_tokens=1)
         except Exception as e:
             console.print(f"[bold red]API Connection Failed ({e}). Switching to MOCK MODE.[/bold red]")
             use_mock = True
-            client = MockGroqClient(api_key="mock_key", port_map=port_map)
-
-    with open(INPUT_FILE, 'r', encoding='utf-8') as f:
-        emails = json.load(f)
-
-    results = []
-    
-    desc = "Processing (MOCK Mode)..." if use_mock else "Processing (REAL Mode)..."
-    
-    # Batch Process with delay
-    for email in track(emails, description=desc):
-        try:
-            res = process_email(client, email, port_map)
-            results.append(res)
-        except Exception as e:
-            console.print(f"[red]Genera Failure {email.get('id')}: {e}[/red]")
-            # Preserve ID in output
-            results.append({"id": email.get('id'), "product_line": None, "origin_port_code": None, "origin_port_name": None, "destination_port_code": None, "destination_port_name": None, "incoterm": "FOB", "cargo_weight_kg": None, "cargo_cbm": None, "is_dangerous": False})
-        
-        if not use_mock:
-            time.sleep(0.4) # Rate limit safety
-
-    with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
-        json.dump(results, f, indent=2)
+            client = MockGroqClient(api_key="mock_key", port_map=port_map, search_patterns=search_patterns, cache_path=EXTRACT_CACHE_FILE)
+
+    # Output mirrors the input format (JSON array or NDJSON)
+    ndjson = is_ndjson(INPUT_FILE)
+    with ShipmentWriter(OUTPUT_FILE, ndjson) as writer:
+        await process_all(client, iter_emails(INPUT_FILE, ndjson), port_index, use_mock, writer)
+    if use_mock:
+        client.save_cache()
     
-    console.print(f"[bold green]Extraction Complete ({'MOCK' if use_mock else 'REAL'}). Results saved to {OUTPUT_FILE}[/bold green]")
+    console.print(f"[bold green]Extraction Complete ({'MOCK' if use_mock else 'REAL'}). {writer.count} results saved to {OUTPUT_FILE}[/bold green]")
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -1,5 +1,9 @@
 # Prompt iterations
 
+from typing import List, Dict
+
+import orjson
+
 PROMPT_V1 = """
 Extract the following details from the email:
 - product_line (pl_sea_import_lcl or pl_sea_export_lcl)
@@ -105,3 +109,86 @@ Body: {body}
 
 **JSON Response:**
 """
+
+# PROMPT_V3 split once around its {subject} / {body} slots, with the literal {{ }} braces already unescaped.
+# Building a prompt is then plain concatenation instead of re-parsing the template with .format() per email.
+PROMPT_V3_PREFIX, _v3_rest = PROMPT_V3.split("{subject}")
+PROMPT_V3_MID, PROMPT_V3_SUFFIX = _v3_rest.split("{body}")
+PROMPT_V3_PREFIX = PROMPT_V3_PREFIX.replace("{{", "{").replace("}}", "}")
+PROMPT_V3_MID = PROMPT_V3_MID.replace("{{", "{").replace("}}", "}")
+PROMPT_V3_SUFFIX = PROMPT_V3_SUFFIX.replace("{{", "{").replace("}}", "}")
+
+def build_prompt_v3(subject: str, body: str) -> str:
+    # Same result as PROMPT_V3.format(subject=subject, body=body)
+    return f"{PROMPT_V3_PREFIX}{subject}{PROMPT_V3_MID}{body}{PROMPT_V3_SUFFIX}"
+
+PROMPT_V4 = """
+You are an expert freight forwarding assistant. Your task is to extract structured shipment details from EACH email in the JSON array below, strictly following the business rules.
+
+### Input Data
+Ref: Port Codes = Use UN/LOCODE (5 chars, e.g., INMAA, HKHKG).
+Emails: JSON array of objects with "id", "subject" and "body". Treat every email independently.
+
+### Business Rules
+
+1. **Product Line**:
+   - `pl_sea_import_lcl` if Destination is India (UN/LOCODE starts with 'IN').
+   - `pl_sea_export_lcl` if Origin is India (UN/LOCODE starts with 'IN').
+   - Default/Context: All shipments are LCL.
+
+2. **Ports**:
+   - Identify Origin and Destination ports.
+   - Return the 5-letter UN/LOCODE.
+   - If a port is not found or ambiguous, return `null`.
+
+3. **Incoterm**:
+   - Allowed: FOB, CIF, CFR, EXW, DDP, DAP, FCA, CPT, CIP, DPU.
+   - Default: `FOB` if missing, ambiguous, or invalid.
+   - Conflict: Body < Subject (Body wins).
+
+4. **Cargo**:
+   - `cargo_weight_kg`: Number (kgs). Convert lbs (* 0.4536) or tonnes (* 1000).
+   - `cargo_cbm`: Number (m3). Extract explicit volume. Do not calc from dims.
+   - Round to 2 decimals.
+   - "0" is 0.0. "TBD"/"N/A" is null.
+
+5. **Dangerous Goods**:
+   - `true` if email mentions: "DG", "hazardous", "Class <num>", "IMO", "IMDG".
+   - `false` if email says: "non-hazardous", "non-DG", "not dangerous".
+   - Default to `false`.
+
+6. **General**:
+   - If an email has multiple shipments, extract the FIRST one.
+   - Return exactly one object per email, with the email's "id" copied unchanged.
+   - Return a valid JSON array only.
+
+### Output Schema
+[
+  {{
+    "id": "id of the email",
+    "product_line": "string or null",
+    "origin_port_code": "string or null",
+    "origin_port_name": "string or null",
+    "destination_port_code": "string or null",
+    "destination_port_name": "string or null",
+    "incoterm": "string",
+    "cargo_weight_kg": number or null,
+    "cargo_cbm": number or null,
+    "is_dangerous": boolean
+  }}
+]
+
+**Emails:**
+{emails}
+
+**JSON Response:**
+"""
+
+# Batch variant of PROMPT_V3: several emails per request, answered with one JSON array.
+PROMPT_V4_PREFIX, PROMPT_V4_SUFFIX = PROMPT_V4.replace("{{", "{").replace("}}", "}").split("{emails}")
+
+def build_prompt_v4(emails: List[Dict]) -> str:
+    # Same result as PROMPT_V4.format(emails=...) with the emails reduced to id, subject and body.
+    # Compact JSON: indentation would only add whitespace tokens to every request.
+    payload = [{"id": e.get("id"), "subject": e.get("subject", ""), "body": e.get("body", "")} for e in emails]
+    return f"{PROMPT_V4_PREFIX}{orjson.dumps(payload).decode()}{PROMPT_V4_SUFFIX}"